@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import argparse
+import binascii
 import json
 import os.path
 import re
@@ -21,8 +22,10 @@ LBL1_HEADER_STRUCT = '%s4sI8sI'
 ATR1_HEADER_STRUCT = '%s4s4I'
 TXT2_HEADER_STRUCT = '%s4s4I'
 
+MSBT_HEADER = struct.Struct(MSBT_HEADER_STRUCT)
+
 SECTION_END_MAGIC = '\xAB'
-COLOR_ESCAPE = '\x03\x00\x04\x00'
+SECTION_END_PADDING = re.compile(b'\xAB*')
 
 ENCODING_UTF8 = 0x00
 ENCODING_UTF16 = 0x01
@@ -32,15 +35,15 @@ ENCODINGS = {
     ENCODING_UTF16: "UTF-16"
 }
 
+STRING_CODECS = {
+    '<': 'utf-16-le',
+    '>': 'utf-16-be'
+}
+
 
 class Msbt:
-    order = None
-    invalid = False
     filename = ''
     file_size = 0
-    header_unknowns = []
-    sections = {}
-    section_order = []
     section_count = 0
     encoding = ENCODING_UTF16
 
@@ -49,12 +52,19 @@ class Msbt:
         self.debug = debug
         self.colors = colors
 
+        self.order = None
+        self._str_codec = None
+        self.invalid = False
+        self.header_unknowns = []
+        self.sections = {}
+        self.section_order = []
+
     def read(self, filename):
         self.filename = filename
         self.file_size = os.stat(filename).st_size
         data = open(self.filename, 'rb').read()
 
-        self._parse_header(data[:MSBT_HEADER_LEN])
+        self._parse_header(data)
         if self.invalid:
             return
         position = MSBT_HEADER_LEN
@@ -64,7 +74,7 @@ class Msbt:
             magic = data[position:position + 4]
 
             if magic == LBL1_MAGIC:
-                self._parse_lbl1_header(data[position:position + LBL1_HEADER_LEN])
+                self._parse_lbl1_header(data, position)
                 position += LBL1_HEADER_LEN
                 if self.invalid:
                     return
@@ -72,7 +82,7 @@ class Msbt:
                 position += self.sections['LBL1']['header']['size']
 
             elif magic == ATR1_MAGIC:
-                self._parse_atr1_header(data[position:position + ATR1_HEADER_LEN])
+                self._parse_atr1_header(data, position)
                 position += ATR1_HEADER_LEN
                 if self.invalid:
                     return
@@ -81,7 +91,7 @@ class Msbt:
                 position += self.sections['ATR1']['header']['size']
 
             elif magic == TXT2_MAGIC:
-                self._parse_txt2_header(data[position:position + TXT2_HEADER_LEN])
+                self._parse_txt2_header(data, position)
                 position += TXT2_HEADER_LEN
                 if self.invalid:
                     return
@@ -92,7 +102,7 @@ class Msbt:
             # elif magic == NLI1_MAGIC:
 
             else:
-                position += struct.unpack('%sI' % self.order, data[position + 4:position + 8])[0]
+                position += struct.unpack_from('%sI' % self.order, data, position + 4)[0]
                 position += TXT2_HEADER_LEN
                 if self.debug:
                     print('\nUnknown section skipped')
@@ -102,10 +112,7 @@ class Msbt:
 
             self.section_order.append(magic)
 
-            while position < self.file_size:
-                if data[position] != '\xAB':
-                    break
-                position += 1
+            position = SECTION_END_PADDING.match(data, position).end()
 
     def save(self, filename):
         output = open(filename, 'wb')
@@ -125,7 +132,7 @@ class Msbt:
             print('MSBT Sections: %d' % self.section_count)
             print('MSBT Unknown3: 0x%x' % self.header_unknowns[2])
             print('MSBT File size: (unknown)')
-            print('MSBT Unknown4: 0x%s\n' % self.header_unknowns[3].encode('hex'))
+            print('MSBT Unknown4: 0x%s\n' % hexlify(self.header_unknowns[3]))
 
         msbt_header = struct.pack(MSBT_HEADER_STRUCT, MSBT_MAGIC, bom, self.header_unknowns[0], self.encoding,
                                   self.header_unknowns[1], self.section_count, self.header_unknowns[2],
@@ -210,6 +217,7 @@ class Msbt:
 
         msbt_header = json_data['structure']['MSBT']['header']
         self.order = msbt_header['byte_order']
+        self._str_codec = STRING_CODECS[self.order]
         self.encoding = msbt_header['encoding']
         self.section_order = msbt_header['section_order']
         self.section_count = msbt_header['sections']
@@ -231,9 +239,9 @@ class Msbt:
 
                 self.sections['TXT2']['data'][id_] = value
 
-    def _parse_header(self, data):
-        magic, bom, unknown1, encoding, unknown2, sections, unknown3, file_size, unknown4 = struct.unpack(
-                MSBT_HEADER_STRUCT, data)
+    def _parse_header(self, data, position=0):
+        magic, bom, unknown1, encoding, unknown2, sections, unknown3, file_size, unknown4 = MSBT_HEADER.unpack_from(
+                data, position)
 
         if magic != MSBT_MAGIC:
             print('Invalid header magic bytes: %s (expected %s)' % (magic, MSBT_MAGIC))
@@ -250,6 +258,8 @@ class Msbt:
             self.invalid = True
             return
 
+        self._str_codec = STRING_CODECS[self.order]
+
         if file_size != self.file_size:
             print('Invalid file size reported: %d (OS reports %d)' % (file_size, self.file_size))
 
@@ -272,10 +282,10 @@ class Msbt:
             print('\nUnknown1: 0x%x' % unknown1)
             print('Unknown2: 0x%x' % unknown2)
             print('Unknown3: 0x%x' % unknown3)
-            print('Unknown4: 0x%s\n' % unknown4.encode('hex'))
+            print('Unknown4: 0x%s\n' % hexlify(unknown4))
 
-    def _parse_lbl1_header(self, data):
-        magic, size, unknown, entries = struct.unpack(LBL1_HEADER_STRUCT % self.order, data)
+    def _parse_lbl1_header(self, data, position=0):
+        magic, size, unknown, entries = struct.unpack_from(LBL1_HEADER_STRUCT % self.order, data, position)
 
         if magic != LBL1_MAGIC:
             print('Invalid LBL1 magic bytes: %s (expected %s)' % (magic, LBL1_MAGIC))
@@ -296,53 +306,52 @@ class Msbt:
             print('LBL1 Size: %d' % size)
             print('LBL1 Entries: %d' % entries)
 
-            print('\nLBL1 Unknown: 0x%s\n' % unknown.encode('hex'))
+            print('\nLBL1 Unknown: 0x%s\n' % hexlify(unknown))
 
     def _parse_lbl1_data(self, data):
         entries = self.sections['LBL1']['header']['entries']
         position = 0
 
-        lists = []
+        lists = [None] * entries
+        unpack_group = struct.Struct('%s2I' % self.order).unpack_from
+        unpack_id = struct.Struct('%sI' % self.order).unpack_from
 
         if self.debug:
             print('\nLBL1 Entries:')
 
-        entry = 1
-        while entries > 0:
-            count, offset = struct.unpack('%s2I' % self.order, data[position:position + 8])
+        for entry in range(entries):
+            count, offset = unpack_group(data, position)
             if self.debug:
-                print('\n#%d' % entry)
-                entry += 1
+                print('\n#%d' % (entry + 1))
                 print('List length: %d' % count)
                 print('First offset: 0x%x' % offset)
 
             position += 8
-            entries -= 1
             offset -= 4
 
-            list_ = []
+            list_ = [None] * count
 
             for i in range(count):
                 length = ord(data[offset])
                 name_end = offset + length + 1
                 name = data[offset + 1:name_end]
                 id_offset = name_end
-                id_ = struct.unpack('%sI' % self.order, data[id_offset:id_offset + 4])[0]
-                list_.append((id_, name))
+                id_ = unpack_id(data, id_offset)[0]
+                list_[i] = (id_, name)
                 offset = id_offset + 4
 
                 if self.debug:
                     print('  %d: %s' % (id_, name))
 
-            lists.append((list_, offset))
+            lists[entry] = (list_, offset)
 
         if self.debug:
             print('')
 
         self.sections['LBL1']['data'] = lists
 
-    def _parse_atr1_header(self, data):
-        magic, size, unknown1, unknown2, entries = struct.unpack(ATR1_HEADER_STRUCT % self.order, data)
+    def _parse_atr1_header(self, data, position=0):
+        magic, size, unknown1, unknown2, entries = struct.unpack_from(ATR1_HEADER_STRUCT % self.order, data, position)
 
         if magic != ATR1_MAGIC:
             print('Invalid ATR1 magic bytes: %s (expected %s)' % (magic, ATR1_MAGIC))
@@ -367,8 +376,8 @@ class Msbt:
             print('\nATR1 Unknown1: 0x%x' % unknown1)
             print('ATR1 Unknown2: 0x%x\n' % unknown2)
 
-    def _parse_txt2_header(self, data):
-        magic, size, unknown1, unknown2, entries = struct.unpack(TXT2_HEADER_STRUCT % self.order, data)
+    def _parse_txt2_header(self, data, position=0):
+        magic, size, unknown1, unknown2, entries = struct.unpack_from(TXT2_HEADER_STRUCT % self.order, data, position)
 
         if magic != TXT2_MAGIC:
             print('Invalid TXT2 magic bytes: %s (expected %s)' % (magic, TXT2_MAGIC))
@@ -395,45 +404,41 @@ class Msbt:
 
     def _parse_txt2_data(self, data):
         entries = self.sections['TXT2']['header']['entries']
-        data_len = len(data)
+        codec = self._str_codec
+        color_escape = u'\x03\x04'.encode(codec)
 
-        offsets = []
-        strings = []
+        offsets = [struct.unpack_from('%sI' % self.order, data, i * 4)[0] - 4 for i in range(entries)]
+        offsets.append(len(data))
+        strings = [None] * entries
 
         for i in range(entries):
-            start = i * 4
-            end = (i + 1) * 4
-            offsets.append(struct.unpack('%sI' % self.order, data[start:end])[0] - 4)
+            string_data = data[offsets[i]:offsets[i + 1]]
 
-        for i in range(entries):
-            start = offsets[i]
-            if i < entries - 1:
-                end = offsets[i + 1]
-            else:
-                end = data_len
-
-            string_data = data[start:end]
+            if not self.colors:
+                # every aligned null is a terminator, anything after the last one is dropped
+                strings[i] = string_data.decode(codec, 'replace').split(u'\x00')[:-1]
+                continue
 
             position = 0
-            string = ''
+            string = b''
             substrings = []
             while position < len(string_data):
-                if self.colors and len(string) >= 4 and string[-4:] == COLOR_ESCAPE:
+                if len(string) >= 4 and string[-4:] == color_escape:
                     # save color information
-                    color = struct.unpack('%sI' % self.order, string_data[position:position + 4])[0]
+                    color = struct.unpack_from('%sI' % self.order, string_data, position)[0]
                     position += 4
-                    string += ('[#%08x]' % color).encode('utf-16-%s' % ('-le' if self.order == '<' else '-be'))
+                    string += ('[#%08x]' % color).encode(codec)
                     continue
 
                 utf16char = string_data[position:position + 2]
-                if utf16char != '\x00\x00':
+                if utf16char != b'\x00\x00':
                     string += utf16char
                 else:
-                    substrings.append(string.decode('utf-16', 'replace'))
-                    string = ''
+                    substrings.append(string.decode(codec, 'replace'))
+                    string = b''
                 position += 2
 
-            strings.append(substrings)
+            strings[i] = substrings
 
         self.sections['TXT2']['data'] = strings
 
@@ -463,7 +468,7 @@ class Msbt:
         if self.debug:
             print('\nLBL1 Magic: %s' % LBL1_MAGIC)
             print('LBL1 Size: %d' % size)
-            print('LBL1 Unknown: 0x%s' % self.sections['LBL1']['header']['unknown'].encode('hex'))
+            print('LBL1 Unknown: 0x%s' % hexlify(self.sections['LBL1']['header']['unknown']))
             print('LBL1 Entries: %d\n' % entries)
 
         return header_bytes + section1_bytes + section2_bytes
@@ -504,16 +509,10 @@ class Msbt:
         # each entry is a single 32-bit integer representing an offset from the start of section1 to an area in section2
         section1_length = entries * 4
 
-        order = ''
-        if self.order == '<':
-            order = '-le'
-        elif self.order == '>':
-            order = '-be'
-
         for string_list in strings:
             section1_bytes += struct.pack('%sI' % self.order, section1_length + len(section2_bytes) + 4)
             for string in string_list:
-                utf16string = string.encode('utf-16%s' % order)
+                utf16string = string.encode(self._str_codec)
 
                 if self.colors:
                     haystack = string
@@ -529,11 +528,11 @@ class Msbt:
                             color = matcher.group('color')
                             color_value = int(color, 16)
                             post = matcher.group('post')
-                            utf16string += pre.encode('utf-16%s' % order)
+                            utf16string += pre.encode(self._str_codec)
                             utf16string += struct.pack('%sI' % self.order, color_value)
                             haystack = post
                         else:
-                            utf16string += haystack.encode('utf-16%s' % order)
+                            utf16string += haystack.encode(self._str_codec)
 
                 section2_bytes += struct.pack('=%ds' % len(utf16string), utf16string)
                 section2_bytes += '\x00\x00'
@@ -551,6 +550,13 @@ class Msbt:
         return header_bytes + section1_bytes + section2_bytes
 
 
+def hexlify(value):
+    # unknown byte fields are str after a JSON round-trip
+    if not isinstance(value, bytes):
+        value = value.encode('latin-1')
+    return binascii.hexlify(value).decode('ascii')
+
+
 def prompt_yes_no(prompt):
     answer_ = None
     while answer_ not in ('y', 'n'):
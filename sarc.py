@@ -1,12 +1,26 @@
 #!/usr/bin/python
 import argparse
+import mmap
+import numpy
 import os
 import os.path
+import shutil
 import struct
 import sys
 
 import zlib
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    # noinspection PyUnresolvedReferences
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
 SARC_HEADER_LEN = 0x14
 SFAT_HEADER_LEN = 0x0c
 SFNT_HEADER_LEN = 0x08
@@ -18,36 +32,63 @@ SFNT_MAGIC = b'SFNT'
 
 SARC_HEADER_STRUCT = '%s4s2H3I'
 SFAT_HEADER_STRUCT = '%s4s2HI'
-SFAT_NODE_STRUCT = '%s4I'
 SFNT_HEADER_STRUCT = '%s4s2H'
 
-READ_AMOUNT = 1024
-DECOMP_AMOUNT = 512
-FILE_READ_SIZE = 1024
+ORDER_BY_BOM = {b'\xff\xfe': '<', b'\xfe\xff': '>'}
+
+SFAT_NODE_DTYPE = numpy.dtype([('hash', numpy.uint32), ('name_offset', numpy.uint32), ('start', numpy.uint32),
+                               ('end', numpy.uint32)])
+
+READ_AMOUNT = 0x40000
+FILE_READ_SIZE = 0x40000
+EXTRACT_WORKERS = 8
+PARALLEL_EXTRACT_SIZE = 0x100000  # average file size the thread pool needs to pay for itself
 
 SARC_HEADER_UNKNOWN = 0x100
 SFAT_HASH_MULTIPLIER = 0x65
 
-STATE_SARC_HEADER = 0
-STATE_SFAT_HEADER = 1
-STATE_SFAT_DATA = 2
-STATE_SFNT_HEADER = 3
-STATE_SFNT_DATA = 4
-STATE_FILE_DATA = 5
-
 DEFAULT_COMPRESSION_LEVEL = 6
 
 
-class Sarc:
-    invalid = False
-    file_nodes = []
-    fnt_data_length = 0
-    extracting = False
-    files = []
-    file_position = 0
+def _decode_name(name):
+    if str is bytes:  # python2 keeps the raw bytes
+        return name
+    # names are utf-8. a broken one still lists and extracts, just with replacement characters
+    return name.decode('utf-8', 'replace')
+
+
+def _encode_name(name):
+    if isinstance(name, bytes):  # python2
+        return name
+    # gives back the bytes os.walk decoded the name from, even ones that aren't valid utf-8
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def _hash_names(chars, starts, lengths, multiplier):
+    # the hash is the polynomial sum(name[i] * multiplier ** (len - 1 - i)) mod 2 ** 32, so with a table of
+    # multiplier powers every name can be hashed at once
+    result = numpy.zeros(len(starts), dtype=numpy.uint32)
+    named = lengths > 0
+    starts = starts[named]
+    lengths = lengths[named]
+    if len(lengths) == 0:
+        return result
+
+    powers = numpy.full(lengths.max(), multiplier, dtype=numpy.uint32)
+    powers[0] = 1
+    powers = numpy.cumprod(powers, dtype=numpy.uint32)
+
+    # lay every name out end to end, pairing each character with the power it's multiplied by
+    firsts = numpy.cumsum(lengths) - lengths
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(firsts, lengths)
+    terms = chars[numpy.repeat(starts, lengths) + offsets] * powers[numpy.repeat(lengths - 1, lengths) - offsets]
+    result[named] = numpy.add.reduceat(terms, firsts)
+    return result
 
+
+class Sarc:
     def __init__(self, filename, compressed=False, verbose=False, extract=False, debug=False, little_endian=True,
-                 list=False, compression_level=DEFAULT_COMPRESSION_LEVEL):
+                 list=False, compression_level=DEFAULT_COMPRESSION_LEVEL, verify=False):
         self.file = open(filename, 'rb' if (extract or list) else 'wb')
         self.filename = filename
         self.outdir = os.path.splitext(filename)[0] + '_'  #if no names
@@ -56,301 +97,340 @@ class Sarc:
         self.extract = extract
         self.debug = debug
         self.compression_level = compression_level
+        self.verify = verify
+
+        self.invalid = False
+        self.fnt_data_length = 0
+        self.files = []
+        self.file_position = 0
+        self.compressor = None
+        self.filenames = None
+        self._by_name = None
+        self._by_hash = None
 
         if not extract and not list:
-            if little_endian:
-                self.order = '<'
-            else:
-                self.order = '>'
+            self._set_order('<' if little_endian else '>')
             self.file_name_hash_mult = SFAT_HASH_MULTIPLIER
+            self.file_hashes = numpy.zeros(0, dtype=numpy.uint32)
 
         if os.path.exists(filename) and (extract or list):
             if compressed:
                 self.file_size = struct.unpack('>I', self.file.read(4))[0]
             else:
                 self.file_size = os.stat(filename).st_size
+                if self.file_size > 0:
+                    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _set_order(self, order):
+        # compile the section structs once the byte order is known
+        self.order = order
+        self.sarc_header_struct = struct.Struct(SARC_HEADER_STRUCT % order)
+        self.sfat_header_struct = struct.Struct(SFAT_HEADER_STRUCT % order)
+        self.sfnt_header_struct = struct.Struct(SFNT_HEADER_STRUCT % order)
+        self.sfat_node_dtype = SFAT_NODE_DTYPE.newbyteorder(order)
 
     def add(self, path):
+        added = len(self.files)
         if os.path.isdir(path):
             for path, dirs, files in os.walk(path):
                 self._add_path(path, dirs, files)
         else:
             self.files.append(path)
 
-        self.files.sort(key=self._file_sort)
-    
-    def _file_sort(self, name):
-        if name.endswith('.noname.bin'):
-            hash_ = int(os.path.split(name)[-1].split('.')[0].lstrip('0x'), 16)
-        else:
-            hash_ = self._calc_filename_hash(name)
-        return hash_
+        # only the new files need hashing, and the hashes are kept in step with the files for save() to reuse.
+        # stable, like list.sort, so files with equal hashes keep the order they were added in
+        hashes = numpy.concatenate((self.file_hashes, self._file_hashes(self.files[added:])))
+        order = numpy.argsort(hashes, kind='mergesort')
+        self.files = [self.files[i] for i in order.tolist()]
+        self.file_hashes = hashes[order]
+
+    def _file_hashes(self, names):
+        hashes = numpy.zeros(len(names), dtype=numpy.uint32)
+        named = []
+        for i, name in enumerate(names):
+            if name.endswith('.noname.bin'):
+                hashes[i] = int(os.path.split(name)[-1].split('.')[0].lstrip('0x'), 16)
+            else:
+                named.append(i)
+
+        # hash every name in one pass over their concatenated bytes
+        encoded = [_encode_name(names[i]) for i in named]
+        lengths = numpy.array([len(name) for name in encoded], dtype=numpy.int64)
+        starts = numpy.cumsum(lengths) - lengths
+        chars = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+        hashes[named] = _hash_names(chars, starts, lengths, self.file_name_hash_mult)
+        return hashes
 
     def _add_path(self, path, dirs, files):
         for file_ in files:
             self.files.append(os.path.join(path, file_))
 
-    def _write(self, data, count=True):
-        self.file.write(data)
-        if count:
-            self.file_position += len(data)
+    def _write(self, data):
+        if self.compressor is not None:
+            self.file.write(self.compressor.compress(data))
+        else:
+            self.file.write(data)
+        self.file_position += len(data)
+
+    def _pad_to(self, position):
+        if position > self.file_position:
+            self._write(b'\x00' * (position - self.file_position))
 
     def save(self):
         bom = 0xFEFF  #because 0xfeff if packed in big endian and 0xfffe in little endian. better to keep the byteorder with the header struct
 
-        header = struct.pack(SARC_HEADER_STRUCT % self.order, SARC_MAGIC, SARC_HEADER_LEN, bom, 0, 0, SARC_HEADER_UNKNOWN)
-
-        self.file_position = 0
-        self._write(header)
-
-        fat_bytes = b''
-        fnt_bytes = b''
-
-        for filename in self.files:
+        # every size is known before anything is written, so lay the whole archive out first. it can then be written
+        # front to back without seeking back to patch offsets, which lets it stream straight through the compressor
+        file_sizes = [os.stat(filename).st_size for filename in self.files]
+        file_starts = []
+        file_end = 0
+        for file_size in file_sizes:
+            file_start = file_end + (-file_end % 0x80)
+            file_starts.append(file_start)
+            file_end = file_start + file_size
+
+        nodes = numpy.zeros(len(self.files), dtype=self.sfat_node_dtype)
+        nodes['hash'] = self.file_hashes
+        nodes['start'] = file_starts
+        nodes['end'] = numpy.add(file_starts, file_sizes)
+        name_offsets = nodes['name_offset']
+        fnt_bytes = bytearray()
+
+        for i, filename in enumerate(self.files):
             if filename.endswith('.noname.bin'):
-                hash_ = int(os.path.split(filename)[-1].split('.')[0].lstrip('0x'), 16)
-                offset = 0x00000000
                 filename = '\x00'*16
             else:
-                hash_ = self._calc_filename_hash(filename)
-                offset = 0x01000000 | len(fnt_bytes) / 4
+                name_offsets[i] = 0x01000000 | len(fnt_bytes) // 4
 
-            fat_bytes += struct.pack(SFAT_NODE_STRUCT % self.order, hash_, offset, 0, 0)
-            fnt_bytes += struct.pack('%s%dsB' % (self.order, len(filename)), filename.encode('ascii'), 0)
+            # null terminated, padded out to the next word
+            fnt_bytes.extend(_encode_name(filename))
+            fnt_bytes.extend(b'\x00' * (4 - len(fnt_bytes) % 4))
 
-            padding = 4 - (len(fnt_bytes) % 4)
-            if padding < 4:
-                fnt_bytes += b'\x00' * padding
+        data_start = SARC_HEADER_LEN + SFAT_HEADER_LEN + nodes.nbytes + SFNT_HEADER_LEN + len(fnt_bytes)
+        data_start += -data_start % 0x100
+        size = data_start + file_end
 
-        fat_header = struct.pack(SFAT_HEADER_STRUCT % self.order, SFAT_MAGIC, SFAT_HEADER_LEN, len(self.files),
-                                 SFAT_HASH_MULTIPLIER)
-        fnt_header = struct.pack(SFNT_HEADER_STRUCT % self.order, SFNT_MAGIC, SFNT_HEADER_LEN, 0)
+        header = self.sarc_header_struct.pack(SARC_MAGIC, SARC_HEADER_LEN, bom, size, data_start, SARC_HEADER_UNKNOWN)
+        fat_header = self.sfat_header_struct.pack(SFAT_MAGIC, SFAT_HEADER_LEN, len(self.files), SFAT_HASH_MULTIPLIER)
+        fnt_header = self.sfnt_header_struct.pack(SFNT_MAGIC, SFNT_HEADER_LEN, 0)
 
-        self._write(fat_header)
-        fat_header_start = self.file_position
-        self._write(fat_bytes)
+        self.file_position = 0
+        if self.compressed:
+            self.file.write(struct.pack('>I', size))
+            self.compressor = self._compressor()
 
+        # python2's zlib only takes read-only buffers, so hand the tables over as bytes
+        self._write(header)
+        self._write(fat_header)
+        self._write(nodes.tobytes())
         self._write(fnt_header)
-        self._write(fnt_bytes)
-
-        data_start = self.file_position
-        padding = 0x100 - (data_start % 0x100)
-        if padding < 0x100:
-            data_start += padding
-            self._write(b'\x00' * padding)
-
-        self.file.seek(0x0c)
-        self._write(struct.pack('%sI' % self.order, data_start), False)
-        self.file.seek(data_start)
+        self._write(bytes(fnt_bytes))
 
         for i in range(len(self.files)):
             filename = self.files[i]
 
-            position = self.file_position
-            padding = 0x80 - (position % 0x80)
-            if padding < 0x80:
-                self._write(b'\x00' * padding)
-                position += padding
+            self._pad_to(data_start + file_starts[i])
 
             if self.verbose:
                 print(filename)
 
-            # adjust file start position
-            file_start = position - data_start
-            file_end = file_start + os.stat(filename).st_size
-            self.file.seek(fat_header_start + (SFAT_NODE_LEN * i) + 0x08)
-            self._write(struct.pack('%s2I' % self.order, file_start, file_end), False)
-            self.file.seek(position)
+            self._copy_in(filename, file_sizes[i])
+
+        self._pad_to(size)
+
+        if self.compressed:
+            self.file.write(self.compressor.flush(zlib.Z_FINISH))
+            self.compressor = None
+
+        self.file.close()
+
+    def _compressor(self):
+        # isa-l only has levels 1-3 (and its 0 still compresses), so other levels stay with zlib
+        if isal_zlib is not None and 0 < self.compression_level <= isal_zlib.ISAL_BEST_COMPRESSION:
+            return isal_zlib.compressobj(self.compression_level)
+        return zlib.compressobj(self.compression_level)
 
-            file = open(filename, 'rb')
+    def _copy_in(self, filename, length):
+        # unbuffered, since every way of copying already moves large chunks
+        file = open(filename, 'rb', 0)
+        if self.compressor is not None:
             data = file.read(FILE_READ_SIZE)
             while len(data) > 0:
                 self._write(data)
                 data = file.read(FILE_READ_SIZE)
+            file.close()
+            return
+        if not hasattr(os, 'sendfile'):  # python2 and windows
+            shutil.copyfileobj(file, self.file, FILE_READ_SIZE)
+            file.close()
+            self.file_position += length
+            return
 
-        size = self.file_position
-        self.file.seek(0x08)
-        self._write(struct.pack('%sI' % self.order, size), False)
+        # let the kernel copy straight from the input file into the archive
+        self.file.flush()
+        start = self.file.tell()
+        offset = 0
+        while offset < length:
+            sent = os.sendfile(self.file.fileno(), file.fileno(), offset, length - offset)
+            if sent == 0:
+                break
+            offset += sent
+        file.close()
+        # the writes went around the file object, so move it past them
+        self.file.seek(start + offset)
+        self.file_position += offset
 
-        self.file.close()
+    def read(self):
+        try:
+            os.mkdir(self.outdir)
+        except:
+            pass
 
-        if self.compressed:
-            self.compress_file()
+        # the whole archive is in memory (or mapped), so every section sits at a known offset
+        data = self._read_data()
+        if len(data) != self.file_size:
+            print('Invalid file size: %d (expected %d)' % (len(data), self.file_size))
+            self.invalid = True
+            return
+        if len(data) < SARC_HEADER_LEN:
+            print('Invalid file size: %d (too small for a SARC header)' % len(data))
+            self.invalid = True
+            return
 
-    def compress_file(self):
-        # stream-compress to another file then overwrite original
-        self.file = open(self.filename, 'rb')
-        compressed_filename = '%s.zlib' % self.filename
-        compressed_file = open(compressed_filename, 'wb')
-        compressor = zlib.compressobj(self.compression_level)
+        position = 0
+        self._parse_header(data, position)
+        if self.invalid:
+            return
+        position += SARC_HEADER_LEN
 
-        compressed_file.write(struct.pack('>I', os.stat(self.filename).st_size))
+        self._parse_fat_header(data, position)
+        if self.invalid:
+            return
+        position += SFAT_HEADER_LEN
 
-        data = self.file.read(READ_AMOUNT)
-        while len(data) > 0:
-            compressed_file.write(compressor.compress(data))
-            data = self.file.read(READ_AMOUNT)
+        node_section_length = SFAT_NODE_LEN * self.file_count
+        self.fnt_data_length = self.file_data_offset - SARC_HEADER_LEN - SFAT_HEADER_LEN - SFNT_HEADER_LEN - node_section_length
+        if self.fnt_data_length < 0:
+            print('Invalid file count: %d (node table overruns the data offset)' % self.file_count)
+            self.invalid = True
+            return
+        self._parse_fat_nodes(data, position)
+        if self.invalid:
+            return
+        position += node_section_length
 
-        compressed_file.write(compressor.flush(zlib.Z_FINISH))
+        self._parse_fnt_header(data, position)
+        if self.invalid:
+            return
+        position += SFNT_HEADER_LEN
 
-        self.file.close()
-        compressed_file.close()
+        self._parse_fnt_data(data, position)
+        if self.invalid:
+            return
 
-        os.rename(compressed_filename, self.filename)
+        if not self.extract:
+            self._list_files()
+            return
 
-    def read(self):
-        if self.compressed:
-            z = zlib.decompressobj()
-        state = STATE_SARC_HEADER
+        # read every file's span out of the node columns once, as plain ints, rather than per file
+        starts = (self.starts.astype(numpy.int64) + self.file_data_offset).tolist()
+        lengths = self.lengths.tolist()
+        paths = self._output_paths()
+        if paths is None:
+            return
 
-        partial_data = b''
-        eof = False
-        get_more = True
-        node_section_length = 0
-        position = 0
-        partial_start = 0
-        file_idx = 0
-        remaining = 0
-        output = None
-        try:
-            os.mkdir(self.outdir)
-        except:
-            pass
+        # handing a copy to the pool costs more than copying a small file, so only go concurrent for big files
+        if (ThreadPoolExecutor is None  # python2 without the futures backport
+                or self.file_count < 2 or sum(lengths) < PARALLEL_EXTRACT_SIZE * self.file_count):
+            for filename, path, start, length in zip(self.filenames, paths, starts, lengths):
+                if self.verbose:
+                    print(filename)
+                if not self._extract_file(data, path, start, length):
+                    return
+            return
 
-        while not eof or len(partial_data) > 0 or self.extracting:
-            if get_more:
-                read_data = self.file.read(READ_AMOUNT)
-                eof = len(read_data) == 0
-
-                if self.compressed:
-                    read_data = z.decompress(z.unconsumed_tail + read_data, DECOMP_AMOUNT)
-
-                position += len(read_data)
-                partial_data += read_data
-                get_more = False
-
-            if state == STATE_SARC_HEADER:
-                if len(partial_data) >= SARC_HEADER_LEN:
-                    self._parse_header(partial_data[:SARC_HEADER_LEN])
-                    if self.invalid:
-                        return
-                    partial_data = partial_data[SARC_HEADER_LEN:]
-                    partial_start += SARC_HEADER_LEN
-                    state = STATE_SFAT_HEADER
-                else:
-                    get_more = True
-            elif state == STATE_SFAT_HEADER:
-                if len(partial_data) >= SFAT_HEADER_LEN:
-                    self._parse_fat_header(partial_data[:SFAT_HEADER_LEN])
-                    if self.invalid:
-                        return
-                    partial_data = partial_data[SFAT_HEADER_LEN:]
-                    partial_start += SFAT_HEADER_LEN
-                    state = STATE_SFAT_DATA
-                    node_section_length = SFAT_NODE_LEN * self.file_count
-                    self.fnt_data_length = self.file_data_offset - SARC_HEADER_LEN - SFAT_HEADER_LEN - SFNT_HEADER_LEN - node_section_length
-                else:
-                    get_more = True
-            elif state == STATE_SFAT_DATA:
-                if len(partial_data) >= node_section_length:
-                    self._parse_fat_nodes(partial_data[:node_section_length])
-                    if self.invalid:
-                        return
-                    partial_data = partial_data[node_section_length:]
-                    partial_start += node_section_length
-                    state = STATE_SFNT_HEADER
-                else:
-                    get_more = True
-            elif state == STATE_SFNT_HEADER:
-                if len(partial_data) >= SFNT_HEADER_LEN:
-                    self._parse_fnt_header(partial_data[:SFNT_HEADER_LEN])
-                    if self.invalid:
-                        return
-                    partial_data = partial_data[SFNT_HEADER_LEN:]
-                    partial_start += SFNT_HEADER_LEN
-                    state = STATE_SFNT_DATA
-                else:
-                    get_more = True
-            elif state == STATE_SFNT_DATA:
-                if len(partial_data) >= self.fnt_data_length:
-                    self._parse_fnt_data(partial_data[:self.fnt_data_length])
-                    if self.invalid:
-                        return
-                    partial_data = partial_data[self.fnt_data_length:]
-                    partial_start += self.fnt_data_length
-                    state = STATE_FILE_DATA
-                else:
-                    get_more = True
-            elif state == STATE_FILE_DATA:
-                if not self.extract:
-                    break
-
-                self.extracting = True
-
-                if remaining == 0:
-                    remaining = self.file_nodes[file_idx]['length']
-                    filename = self.file_nodes[file_idx]['filename']
-
-                    if self.verbose:
-                        print(filename)
-                    if not self.file_nodes[file_idx]['has_name']:
-                        filename = os.path.join(self.outdir, filename)
-                    dirname = os.path.dirname(filename)
-                    if len(dirname) > 0 and not os.path.exists(dirname):
-                        try:
-                            os.makedirs(dirname)
-                        except OSError:
-                            print("Couldn't create directory: %s" % dirname)
-                            return
-                    output = open(filename, 'wb')
-
-                if remaining == self.file_nodes[file_idx]['length']:
-                    start = self.file_nodes[file_idx]['start'] + self.file_data_offset
-                    if position > start and partial_start <= start:
-                        data_start = start - partial_start
-                        partial_data = partial_data[data_start:]
-                        partial_start += data_start
-                    elif partial_start > start:
-                        print("Couldn't extract file data.")
-                        return
-                    else:
-                        get_more = True
-                        continue
-
-                partial_len = len(partial_data)
-                if partial_len < remaining:
-                    output.write(partial_data)
-                    remaining -= partial_len
-                    partial_data = b''
-                    partial_start = position
-                    get_more = True
-                else:
-                    output.write(partial_data[:remaining])
-                    output.close()
-                    partial_data = partial_data[remaining:]
-                    partial_start += remaining
-                    remaining = 0
-                    file_idx += 1
-                    if file_idx >= self.file_count:
-                        break
+        # every file is an independent span of the archive (or of the decompressed buffer), so they can be copied
+        # out concurrently. the copies run outside the GIL
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+            futures = [pool.submit(self._extract_file, data, path, start, length)
+                       for path, start, length in zip(paths, starts, lengths)]
+            for filename, future in zip(self.filenames, futures):
+                if self.verbose:
+                    print(filename)
+                if not future.result():
+                    # stop like the sequential loop does, skipping every copy that hasn't started yet
+                    for future in futures:
+                        future.cancel()
+                    return
 
-        if not self.extract:
-            self._list_files()
+    def _extract_file(self, data, path, start, length):
+        output = open(path, 'wb')
+        extracted = self._copy_out(output, data, start, length)
+        output.close()
+        return extracted
 
-    def _parse_header(self, data):
-        bom = data[6:8]
-        try:  #python3
-            int_bom = int.from_bytes(bom, 'big')  #for error messages
-        except:
-            int_bom = (ord(bom[0]) << 8) + ord(bom[1])
-        
-        if bom not in [b'\xff\xfe', b'\xfe\xff']:
-            print('Invalid byte-order marker: 0x%x (expected either 0xFFFE or 0xFEFF)' % int_bom)
+    def _read_data(self):
+        if not self.compressed:
+            return self.mm if self.file_size > 0 else b''
+
+        # the expanded size is known up front, so decompress straight into a buffer of that size
+        z = zlib.decompressobj() if isal_zlib is None else isal_zlib.decompressobj()
+        data = bytearray(self.file_size)
+        position = 0
+        read_data = self.file.read(READ_AMOUNT)
+        while True:
+            chunk = z.decompress(read_data) if len(read_data) > 0 else z.flush()
+            data[position:position + len(chunk)] = chunk
+            position += len(chunk)
+            if len(read_data) == 0:
+                break
+            read_data = self.file.read(READ_AMOUNT)
+
+        # a short stream must not leave zero padding behind that passes the size check
+        del data[position:]
+        return data
+
+    def _copy_out(self, output, data, start, length):
+        if self.compressed:
+            output.write(memoryview(data)[start:start + length])
+            return True
+        if not hasattr(os, 'sendfile'):  # python2 and windows
+            output.write(data[start:start + length])
+            return True
+
+        # let the kernel copy straight from the archive into the output file
+        while length > 0:
+            sent = os.sendfile(output.fileno(), self.file.fileno(), start, length)
+            if sent == 0:
+                print("Couldn't extract file data.")
+                return False
+            start += sent
+            length -= sent
+        return True
+
+    def _output_paths(self):
+        # create every output directory up front, once each, instead of checking for it before every file
+        paths = [filename if has_name else os.path.join(self.outdir, filename)
+                 for filename, has_name in zip(self.filenames, self.has_names.tolist())]
+        for dirname in sorted(set(os.path.dirname(path) for path in paths)):
+            if len(dirname) > 0 and not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    print("Couldn't create directory: %s" % dirname)
+                    return None
+        return paths
+
+    def _parse_header(self, data, position=0):
+        order = ORDER_BY_BOM.get(bytes(data[position + 6:position + 8]))
+        if order is None:
+            bom, = struct.unpack_from('>H', data, position + 6)
+            print('Invalid byte-order marker: 0x%x (expected either 0xFFFE or 0xFEFF)' % bom)
             self.invalid = True
             return
-        
-        self.order = '<' if (bom == b'\xff\xfe') else '>'
-        magic, header_len, bom, file_len, data_offset, unknown = struct.unpack(SARC_HEADER_STRUCT % self.order, data)
+
+        self._set_order(order)
+        magic, header_len, bom, file_len, data_offset, unknown = self.sarc_header_struct.unpack_from(data, position)
 
         if magic != SARC_MAGIC:
             print('Invalid SARC magic bytes: %s (expected "%s")' % (magic, SARC_MAGIC))
@@ -362,11 +442,6 @@ class Sarc:
             self.invalid = True
             return
 
-        if self.order is None:
-            print('Invalid byte-order marker: 0x%x (expected either 0xFFFE or 0xFEFF)' % int_bom)
-            self.invalid = True
-            return
-
         if file_len != self.file_size:
             print('Invalid file size: %d (expected %d)' % (file_len, self.file_size))
             self.invalid = True
@@ -388,8 +463,8 @@ class Sarc:
 
             print('\nSARC Unknown: 0x%x\n' % unknown)
 
-    def _parse_fat_header(self, data):
-        magic, header_len, node_count, hash_multiplier = struct.unpack(SFAT_HEADER_STRUCT % self.order, data)
+    def _parse_fat_header(self, data, position=0):
+        magic, header_len, node_count, hash_multiplier = self.sfat_header_struct.unpack_from(data, position)
 
         if magic != SFAT_MAGIC:
             print('Invalid SFAT magic bytes: %s (expected "%s")' % (magic, SFAT_MAGIC))
@@ -410,30 +485,23 @@ class Sarc:
             print('SFAT File count: %d' % node_count)
             print('SFAT Hash multiplier: 0x%x\n' % hash_multiplier)
 
-    def _parse_fat_nodes(self, data):
-        idx = 0
-        for i in range(self.file_count):
-            node_data = data[idx:idx + SFAT_NODE_LEN]
-            idx += SFAT_NODE_LEN
-
-            hash, name_offset, data_start, data_end = struct.unpack(SFAT_NODE_STRUCT % self.order, node_data)
-            # first byte is to determine if the file name is stored in SFNT
-            has_name = name_offset >> 24
-            # trim off first byte
-            name_offset &= 0xFFFFFF
-            name_offset *= 4
-
-            self.file_nodes.append({
-                'hash': hash,
-                'has_name': has_name,
-                'name_offset': name_offset,
-                'start': data_start,
-                'end': data_end,
-                'length': (data_end - data_start)
-            })
-
-    def _parse_fnt_header(self, data):
-        magic, header_length, unknown = struct.unpack(SFNT_HEADER_STRUCT % self.order, data)
+    def _parse_fat_nodes(self, data, position=0):
+        nodes = numpy.frombuffer(data, dtype=self.sfat_node_dtype, count=self.file_count, offset=position)
+
+        # keep each field as its own contiguous native-order column rather than strided views of the records,
+        # which also means no view of the read buffer is kept alive
+        self.hashes = nodes['hash'].astype(numpy.uint32)
+        name_offsets = nodes['name_offset'].astype(numpy.uint32)
+        # first byte is to determine if the file name is stored in SFNT
+        self.has_names = name_offsets >> 24
+        # trim off first byte
+        self.name_offsets = (name_offsets & 0xFFFFFF) * 4
+        self.starts = nodes['start'].astype(numpy.uint32)
+        self.ends = nodes['end'].astype(numpy.uint32)
+        self.lengths = self.ends - self.starts
+
+    def _parse_fnt_header(self, data, position=0):
+        magic, header_length, unknown = self.sfnt_header_struct.unpack_from(data, position)
 
         if magic != SFNT_MAGIC:
             print('Invalid SFNT magic bytes: %s (expected "%s")' % (magic, SFNT_MAGIC))
@@ -451,38 +519,69 @@ class Sarc:
 
             print('\nSFNT Unknown: 0x%x\n' % unknown)
 
-    def _parse_fnt_data(self, data):
-        for node in self.file_nodes:
-            if node['has_name']:
-                start = node['name_offset']
-                end = data.find(b'\0', start)
-                node['filename'] = data[start:end]
-
-                if self.debug:
-                    print('File name: %s' % node['filename'])
-                    print('File name hash: 0x%x' % node['hash'])
-                    print('File data start: %d' % node['start'])
-                    print('File length: %d\n' % node['length'])
-
-                hash = self._calc_filename_hash(node['filename'])
-                if node['hash'] != hash:
-                    print('Invalid filename: %s' % node['filename'])
-                    print('Hash: 0x%x (expected 0x%x)' % (hash, node['hash']))
-                    self.invalid = True
-                    return
-            else:
-                node['filename'] = '0x%08x.noname.bin' % node['hash']
+    def _parse_fnt_data(self, data, position=0):
+        self.filenames = [None] * self.file_count
+
+        chars = numpy.frombuffer(data, dtype=numpy.uint8, count=self.fnt_data_length, offset=position)
+        named = numpy.flatnonzero(self.has_names)
+        name_starts = numpy.minimum(self.name_offsets[named], len(chars)).astype(numpy.int64)
+        # each name ends at the first null at or after its offset (or at the end of the section)
+        nulls = numpy.append(numpy.flatnonzero(chars == 0), len(chars))
+        name_ends = nulls[numpy.searchsorted(nulls, name_starts)]
+
+        for i in numpy.flatnonzero(self.has_names == 0).tolist():
+            self.filenames[i] = '0x%08x.noname.bin' % self.hashes[i]
+
+        # decode each name from its own bytes, since the section also holds the alignment padding
+        for i, start, end in zip(named.tolist(), name_starts.tolist(), name_ends.tolist()):
+            filename = _decode_name(chars[start:end].tobytes())
+            self.filenames[i] = filename
+
+            if self.debug:
+                print('File name: %s' % filename)
+                print('File name hash: 0x%x' % self.hashes[i])
+                print('File data start: %d' % self.starts[i])
+                print('File length: %d\n' % self.lengths[i])
+
+        if not self.verify:
+            return
+
+        name_hashes = _hash_names(chars, name_starts, name_ends - name_starts, self.file_name_hash_mult)
+        bad = numpy.flatnonzero(self.hashes[named] != name_hashes)
+        for j in bad.tolist():
+            i = named[j]
+            print('Invalid filename: %s' % self.filenames[i])
+            print('Hash: 0x%x (expected 0x%x)' % (name_hashes[j], self.hashes[i]))
+        if len(bad) > 0:
+            self.invalid = True
+
+    def find(self, name):
+        # index of the named file, or None (also before the archive has been read). the indexes are only built on
+        # the first lookup, and the first of any duplicates wins
+        if self.filenames is None:
+            return None
+        if self._by_name is None:
+            self._by_name = {}
+            for i, filename in enumerate(self.filenames):
+                self._by_name.setdefault(filename, i)
+            # files whose names weren't stored can only be matched by hash
+            self._by_hash = {}
+            for i in numpy.flatnonzero(self.has_names == 0).tolist():
+                self._by_hash.setdefault(int(self.hashes[i]), i)
+
+        if name in self._by_name:
+            return self._by_name[name]
+        return self._by_hash.get(self._calc_filename_hash(name))
 
     def _calc_filename_hash(self, name):
-        result = 0
-        for c in name:
-            result = ord(c) + (result * self.file_name_hash_mult)
-            result &= 0xFFFFFFFF
-        return result
+        name = _encode_name(name)
+        hashes = _hash_names(numpy.frombuffer(name, dtype=numpy.uint8), numpy.zeros(1, dtype=numpy.int64),
+                             numpy.array([len(name)], dtype=numpy.int64), self.file_name_hash_mult)
+        return int(hashes[0])
 
     def _list_files(self):
-        for node in self.file_nodes:
-            print(node['filename'])
+        if self.file_count > 0:
+            print('\n'.join(self.filenames))
 
 
 if __name__ == '__main__':
@@ -495,6 +594,8 @@ if __name__ == '__main__':
                         default=False)
     parser.add_argument('--compression-level', metavar='LEVEL', help='ZLIB compression level (default: 6)', type=int,
                         default=DEFAULT_COMPRESSION_LEVEL)
+    parser.add_argument('--verify', help='check filename hashes when reading an archive', action='store_true',
+                        default=False)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-x', '--extract', help='extract the SARC', action='store_true', default=False)
     group.add_argument('-c', '--create', help='create a SARC', action='store_true', default=False)
@@ -537,7 +638,8 @@ if __name__ == '__main__':
         sys.exit(1)
 
     sarc = Sarc(args.archive, compressed=args.zlib, verbose=args.verbose, debug=args.debug, extract=args.extract,
-                list=args.list, little_endian=args.little_endian, compression_level=args.compression_level)
+                list=args.list, little_endian=args.little_endian, compression_level=args.compression_level,
+                verify=args.verify)
 
     if args.extract or args.list:
         sarc.read()